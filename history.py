@@ -0,0 +1,197 @@
+import atexit
+import sys
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import case
+from models import Track, PlayEvent, PlayCount, SQL_CHUNK, db
+
+
+def day_key(timestamp):
+    """ The PlayCount key for the (UTC) day containing `timestamp`. """
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+
+def roll_up(events):
+    """ Add the given PlayEvents to the PlayCount totals. Events for tracks
+    that are no longer in the database are skipped; the others are returned.
+    """
+    track_ids = set(e.track_id for e in events)
+    tracks = dict((t.id, t) for t in
+                  Track.query.filter(Track.id.in_(track_ids)).all())
+
+    totals = {}  # Maps (kind, key) to [plays, last_played].
+    kept = []
+    for event in events:
+        track = tracks.get(event.track_id)
+        if track is None:
+            continue
+        kept.append(event)
+
+        keys = [('track', unicode(track.id)),
+                ('artist', track.artist),
+                ('day', day_key(event.played_at))]
+        if track.album_id is not None:
+            keys.append(('album', unicode(track.album_id)))
+
+        for key in keys:
+            total = totals.setdefault(key, [0, event.played_at])
+            total[0] += 1
+            total[1] = max(total[1], event.played_at)
+
+    # Increment in SQL rather than read-modify-write, so that totals stay
+    # right even if another process is rolling up at the same time.
+    for (kind, key), (plays, last_played) in totals.iteritems():
+        updated = PlayCount.query.filter_by(kind=kind, key=key).update({
+            PlayCount.plays: PlayCount.plays + plays,
+            PlayCount.last_played: case(
+                [(PlayCount.last_played == None, last_played),
+                 (PlayCount.last_played < last_played, last_played)],
+                else_=PlayCount.last_played)
+        }, synchronize_session=False)
+        if not updated:
+            # Should another process insert the same row first, the unique
+            # index fails this batch, and PlayLog.flush() retries it.
+            db.session.add(PlayCount(kind, key, plays, last_played))
+    db.session.flush()
+
+    return kept
+
+
+def rebuild_rollups(chunk_size=1000):
+    """ Recompute all PlayCount totals from the full play history. """
+    PlayCount.query.delete()
+    last_id = 0
+    while True:
+        events = (PlayEvent.query.filter(PlayEvent.id > last_id)
+                  .order_by(PlayEvent.id).limit(chunk_size).all())
+        if not events:
+            break
+        roll_up(events)
+        db.session.flush()
+        last_id = events[-1].id
+    db.session.commit()
+
+
+def forget(track_ids, album_ids=()):
+    """ Detach the play history from tracks and albums that have left the
+    library, since their IDs may be reused: events keep their times but
+    lose their track, and the tracks' and albums' totals are dropped.
+    Artist and day totals keep the plays. """
+    track_ids, album_ids = list(track_ids), list(album_ids)
+    for start in xrange(0, len(track_ids), SQL_CHUNK):
+        chunk = track_ids[start:start + SQL_CHUNK]
+        PlayEvent.query.filter(PlayEvent.track_id.in_(chunk)).update(
+            {PlayEvent.track_id: None}, synchronize_session=False)
+        PlayCount.query.filter(
+            PlayCount.kind == 'track',
+            PlayCount.key.in_([unicode(i) for i in chunk])
+        ).delete(synchronize_session=False)
+    for start in xrange(0, len(album_ids), SQL_CHUNK):
+        PlayCount.query.filter(
+            PlayCount.kind == 'album',
+            PlayCount.key.in_([unicode(i) for i in
+                               album_ids[start:start + SQL_CHUNK]])
+        ).delete(synchronize_session=False)
+
+
+class PlayLog(object):
+    """ Buffers play events in memory and writes them to the database in
+    batches, so that recording a play never waits on the database.
+
+    A batch is written from a background thread once `batch_size` events are
+    waiting or `max_delay` seconds have passed since the last write. Anything
+    still buffered is written when the process exits, or when flush() is
+    called directly (e.g. before reading stats).
+
+    After a failed write, the next is only tried once `max_delay` has passed.
+    If `max_attempts` writes fail in a row, the buffered events are dropped,
+    so that a problem that won't go away can't make the buffer grow forever.
+    """
+
+    def __init__(self, app=None, batch_size=50, max_delay=60,
+                 max_attempts=3):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._buffer = []
+        self._lock = threading.Lock()  # Guards the buffer.
+        self._flush_lock = threading.Lock()  # Held while writing.
+        self._flushing = False
+        self._failures = 0  # Writes failed in a row.
+        self._last_flush = time.time()
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        atexit.register(self._flush_in_context)
+
+    def record(self, user, track_id, played_at=None):
+        """ Queue a play of `track_id` by `user`. Returns immediately. """
+        event = (user, track_id, played_at or time.time())
+        with self._lock:
+            self._buffer.append(event)
+            due = not self._flushing and (
+                (len(self._buffer) >= self.batch_size and
+                 not self._failures) or
+                time.time() - self._last_flush >= self.max_delay)
+            if due:
+                self._flushing = True
+
+        if due:
+            thread = threading.Thread(target=self._flush_in_context)
+            thread.daemon = True
+            thread.start()
+
+    def pending(self):
+        """ The number of events not yet written. """
+        with self._lock:
+            return len(self._buffer)
+
+    def flush(self):
+        """ Write all buffered events and update the rollups. This needs an
+        application context. Returns the number of events written.
+
+        If the write fails (e.g. the database is locked by an update), the
+        events go back in the buffer to be retried with the next batch, up
+        to `max_attempts` times.
+        """
+        with self._flush_lock:
+            with self._lock:
+                events, self._buffer = self._buffer, []
+                self._last_flush = time.time()
+            if not events:
+                return 0
+
+            try:
+                rows = roll_up([PlayEvent(*e) for e in events])
+                db.session.add_all(rows)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self._failures += 1
+                if self._failures >= self.max_attempts:
+                    self._failures = 0
+                    sys.stderr.write(
+                        u'Could not write {0} play events after {1} '
+                        u'attempts, dropping them: {2}\n'
+                        .format(len(events), self.max_attempts, e))
+                    return 0
+                with self._lock:
+                    self._buffer[:0] = events
+                sys.stderr.write(
+                    u'Could not write {0} play events, will retry: {1}\n'
+                    .format(len(events), e))
+                return 0
+            self._failures = 0
+            return len(rows)
+
+    def _flush_in_context(self):
+        try:
+            with self.app.app_context():
+                self.flush()
+                db.session.remove()
+        finally:
+            self._flushing = False
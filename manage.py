@@ -1,22 +1,39 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
+import hashlib
 import os
 import re
 import sys
 from datetime import datetime
 import mutagen
 from flask.ext.script import Manager
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.sql import select
-from models import Track, Album, db
+from models import Track, Album, Playlist, Library, db
 from potsfyi import app
+from history import rebuild_rollups, forget
+import transcode
 
 
 manager = Manager(app)
 
 HANDLED_FILETYPES = ('.ogg', '.mp3', '.flac', '.m4a')
 
+# Bytes read from each end of a file to fingerprint it.
+FINGERPRINT_CHUNK = 8192
+
+# Codecs for Mutagen file types whose info doesn't say.
+CODECS = {
+    'MP3': 'mp3',
+    'EasyMP3': 'mp3',
+    'OggVorbis': 'vorbis',
+    'OggOpus': 'opus',
+    'FLAC': 'flac',
+    'MP4': 'aac',
+    'EasyMP4': 'aac'
+}
+
 
 def track_num_to_int(track_num_str):
     """ Convert a track number tag value to an int.
@@ -69,6 +86,24 @@ class MetadataError(Exception):
         return self.reason
 
 
+def audio_properties(file_info, size):
+    """ Return a dict of a file's duration, bitrate, sample rate and codec
+    (where known), given the file as opened by Mutagen and its size. """
+    info = file_info.info
+    duration = getattr(info, 'length', None) or None
+    bitrate = getattr(info, 'bitrate', None) or None
+    if bitrate is None and duration:
+        # E.g. FLAC doesn't report a bitrate; use the average.
+        bitrate = int(size * 8 / duration)
+    return {
+        'duration': duration,
+        'bitrate': bitrate,
+        'sample_rate': getattr(info, 'sample_rate', None),
+        'codec': (getattr(info, 'codec', None) or
+                  CODECS.get(type(file_info).__name__))
+    }
+
+
 def get_or_create_album(artist, title, **kwargs):
     """ Return the object or make it if the artist/title pair doesn't exist.
     """
@@ -82,9 +117,12 @@ def get_or_create_album(artist, title, **kwargs):
         return instance
 
 
-def aggregate_metadata(full_filename, music_dir, cover_art):
+def aggregate_metadata(full_filename, music_dir, cover_art, track=None):
     """ Take a full path to a file and the root music_dir. Return Track
     and Album objects (or None for no album) corresponding to that file.
+
+    If `track` is given, it's updated from the file instead of a new Track
+    being made, so that it keeps its ID.
     """
     mtime = os.path.getmtime(full_filename)
     relative_filename = os.path.relpath(full_filename, music_dir)
@@ -127,17 +165,70 @@ def aggregate_metadata(full_filename, music_dir, cover_art):
             cover_art=cover_art
         )
 
-    track = Track(
+    size, content_hash = fingerprint(full_filename)
+
+    fields = dict(
         artist=artist,
         title=title,
-        filename=relative_filename,
         album=album,
         track_num=track_num,
-        mtime=mtime
+        mtime=int(mtime),
+        size=size,
+        content_hash=content_hash,
+        **audio_properties(tag_info, size)
     )
+    if track is None:
+        track = Track(filename=relative_filename, **fields)
+    else:
+        for name, value in fields.iteritems():
+            setattr(track, name, value)
+        track.update_search_keys()
     return track, album
 
 
+def fingerprint(full_filename):
+    """ Return a (size, content hash) pair identifying a file's contents,
+    cheap enough to compute while scanning. Only the size and the first
+    and last FINGERPRINT_CHUNK bytes are hashed. """
+    size = os.path.getsize(full_filename)
+    digest = hashlib.sha1(str(size))
+    with open(full_filename, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_CHUNK))
+        if size > FINGERPRINT_CHUNK:
+            f.seek(max(FINGERPRINT_CHUNK, size - FINGERPRINT_CHUNK))
+            digest.update(f.read(FINGERPRINT_CHUNK))
+    return size, digest.hexdigest()
+
+
+def add_audio_properties(track, full_filename):
+    """ Set `track`'s audio properties from its file, if it can be read.
+    """
+    try:
+        file_info = mutagen.File(full_filename)
+    except:
+        # XXX: See aggregate_metadata() on catching all exceptions here.
+        return
+    if file_info is not None:
+        properties = audio_properties(file_info,
+                                      os.path.getsize(full_filename))
+        for name, value in properties.iteritems():
+            setattr(track, name, value)
+
+
+def read_track(full_filename, music_dir, cover_art, track=None):
+    """ Return a new Track for the given file via aggregate_metadata() (or
+    `track`, updated), or None (after saying why) if its metadata can't be
+    used. """
+    try:
+        (track, _album) = aggregate_metadata(full_filename, music_dir,
+                                             cover_art, track)
+    except MetadataError as e:
+        sys.stderr.write(u'\r\033[KSkipping {0}: {1}\n'.format(
+            os.path.relpath(full_filename, music_dir), e))
+        return None
+    return track
+
+
 def get_cover_art(music_dir, path, file_list):
     """ Look for cover art among the files in `file_list`. If found,
     return a filename relative to the given `music_dir`. """
@@ -148,6 +239,27 @@ def get_cover_art(music_dir, path, file_list):
             return os.path.relpath(os.path.join(path, testfile), music_dir)
 
 
+def upgrade_schema():
+    """ Create any missing tables, and add any columns and indexes that
+    were introduced since the database was first made (create_all() only
+    adds whole tables). """
+    db.create_all()
+    inspector = Inspector.from_engine(db.engine)
+    for table in db.metadata.sorted_tables:
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                db.engine.execute(u'ALTER TABLE {0} ADD COLUMN {1} {2}'
+                                  .format(table.name, column.name,
+                                          column.type.compile(
+                                              db.engine.dialect)))
+
+        indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(db.engine)
+
+
 @manager.command
 def update(quiet=False):
     """ Updates the music database to reflect the contents of your music
@@ -159,6 +271,25 @@ def update(quiet=False):
     update_db(unicode(app.config['MUSIC_DIR']), quiet)
 
 
+@manager.command
+def rollup():
+    """ Rebuilds the play statistics (most played tracks, albums, artists
+    and days) from the full play history. """
+    rebuild_rollups()
+
+
+@manager.command
+def prune_cache():
+    """ Removes transcoded audio in TRANSCODE_CACHE_DIR that is no longer
+    needed, because its track has been removed from the library. """
+    cache_dir = app.config['TRANSCODE_CACHE_DIR']
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return
+    removed = transcode.prune_cache(cache_dir, Track.query.all())
+    sys.stderr.write(u'Removed {0} cached {1}.\n'.format(
+        removed, 'file' + ('' if removed == 1 else 's')))
+
+
 def update_db(music_dir, quiet=True):
     """ Update the music database to reflect contents of `music_dir` (and
     its subdirectories). If `quiet`, no status line is printed.
@@ -168,18 +299,28 @@ def update_db(music_dir, quiet=True):
     writing tests.
     """
 
-    # Create the appropriate DB tables if they don't exist.
-    try:
-        Track.query.all()
-    except OperationalError:
-        db.create_all()
+    # Create the appropriate DB tables if they don't exist, or bring an
+    # older database's tables up to date.
+    upgrade_schema()
+
+    # Fill in search keys for anything added before they existed.
+    for model in (Track, Album):
+        for instance in model.query.filter(model.title_key == None):
+            instance.update_search_keys()
 
     # In order to delete tracks that are in the DB but no longer
     # exist on disk, we keep track here of all track filenames
     # encountered. Others will be removed from the DB at the end.
     filenames_found = set()
 
+    # Files not yet in the DB. These are handled after the whole directory
+    # has been walked, since they may be tracks that were moved or renamed.
+    new_files = []
+
+    known_tracks = dict((t.filename, t) for t in Track.query.all())
+
     track_count = 0  # For printing status.
+    changed = False  # Whether anything was added, updated or removed.
     start_time = datetime.today()
 
     for path, _, files in os.walk(music_dir, followlinks=True):
@@ -195,28 +336,32 @@ def update_db(music_dir, quiet=True):
             relative_filename = os.path.relpath(full_filename, music_dir)
 
             filenames_found.add(relative_filename)
-            track = Track.query.filter_by(filename=relative_filename).first()
-
-            # Add a track entry, or update it if the file's mtime changed.
-            if track is None or track.mtime != mtime:
-                try:
-                    (_track, _album) = aggregate_metadata(full_filename,
-                                                          music_dir,
-                                                          cover_art)
-                except MetadataError as e:
+            track = known_tracks.get(relative_filename)
+
+            if track is None:
+                new_files.append((full_filename, relative_filename, mtime,
+                                  cover_art))
+                continue
+
+            # Update the track entry if the file's mtime changed. It's
+            # updated in place, keeping the ID that playlists and the play
+            # history refer to.
+            if track.mtime != mtime:
+                if read_track(full_filename, music_dir, cover_art,
+                              track) is None:
                     # Track doesn't have valid metadata.
-                    # If it was in the DB previously, removing from
-                    # filenames_found will get it removed when we clean the
-                    # DB at the end.
+                    # Removing from filenames_found will get it removed
+                    # when we clean the DB at the end.
                     filenames_found.remove(relative_filename)
-
-                    sys.stderr.write(u'\r\033[KSkipping {0}: {1}\n'.format(
-                        relative_filename, e))
                     continue
-
-                if track is not None:
-                    db.session.delete(track)
-                db.session.add(_track)
+                changed = True
+            else:
+                # Fill in anything added since the track was scanned.
+                if track.content_hash is None:
+                    track.size, track.content_hash = fingerprint(
+                        full_filename)
+                if track.duration is None:
+                    add_audio_properties(track, full_filename)
 
             # Increment the track count only in case of valid metadata,
             # so the final count will match the number in the database.
@@ -228,10 +373,51 @@ def update_db(music_dir, quiet=True):
             sys.stderr.write(u'\r\033[K{0} tracks; in {1}'.format(
                 track_count, last_path_component[:60]))
 
+    # Tracks that have vanished from where they were may have been moved
+    # or renamed. Index them by fingerprint to match against new files.
+    vanished = {}
+    for track in known_tracks.itervalues():
+        if (track.filename not in filenames_found and
+                track.content_hash is not None):
+            vanished.setdefault((track.size, track.content_hash),
+                                []).append(track)
+    vanished_sizes = set(size for size, _ in vanished)
+
+    for full_filename, relative_filename, mtime, cover_art in new_files:
+        # Only files with the same size as a vanished track need hashing.
+        if os.path.getsize(full_filename) in vanished_sizes:
+            moved = vanished.get(fingerprint(full_filename))
+            if moved:
+                # Relink the existing entry, keeping its ID, rather than
+                # reading the tags again.
+                track = moved.pop()
+                track.filename = relative_filename
+                track.mtime = mtime
+                if cover_art is not None and track.album is not None:
+                    track.album.cover_art = cover_art
+                track_count += 1
+                changed = True
+                continue
+
+        _track = read_track(full_filename, music_dir, cover_art)
+        if _track is None:
+            filenames_found.remove(relative_filename)
+            continue
+        db.session.add(_track)
+        track_count += 1
+        changed = True
+
+        if not quiet and track_count % 100 == 0:
+            sys.stderr.write(u'\r\033[K{0} tracks; in {1}'.format(
+                track_count, os.path.dirname(relative_filename)[-60:]))
+
     # Purge the database entries that aren't in the music directory.
-    for track in Track.query.all():
+    removed_ids = []
+    for track in known_tracks.itervalues():
         if track.filename not in filenames_found:
+            removed_ids.append(track.id)
             db.session.delete(track)
+            changed = True
     db.session.flush()
 
     # Remove albums which contain no tracks.
@@ -245,6 +431,18 @@ def update_db(music_dir, quiet=True):
     for album in orphaned_albums:
         db.session.delete(album)
 
+    # SQLite may give a removed track's or album's ID to a new one, so
+    # nothing may go on referring to them.
+    Playlist.remove_tracks(removed_ids)
+    forget(removed_ids, [album.id for album in orphaned_albums])
+
+    if changed:
+        library = Library.query.first()
+        if library is None:
+            library = Library()
+            db.session.add(library)
+        library.version += 1
+
     db.session.commit()
 
     end_time = datetime.today()
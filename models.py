@@ -1,9 +1,26 @@
+# coding: utf-8
+import unicodedata
 from sqlalchemy.orm import relationship, backref
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy import (Column, Integer, Float, String, Boolean, ForeignKey,
+                        Index, func)
 from flask.ext.sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()  # Imported and initialized in potsfyi.py.
 
+# Most IDs to put in one IN clause (SQLite allows 999 parameters).
+SQL_CHUNK = 500
+
+
+def search_key(text):
+    """ Fold `text` for accent- and case-insensitive matching, so that
+    e.g. u'Björk' and u'BJORK' both become u'bjork'. """
+    if text is None:
+        return None
+    decomposed = unicodedata.normalize('NFKD', unicode(text))
+    return u''.join(c for c in decomposed
+                    if not unicodedata.combining(c)).lower()
+
 
 class Track(db.Model):
     __tablename__ = 'track'
@@ -11,22 +28,47 @@ class Track(db.Model):
     id = Column(Integer, primary_key=True)
     artist = Column(String(200))
     title = Column(String(240))
+    # Folded with search_key(), for searching.
+    artist_key = Column(String(200), index=True)
+    title_key = Column(String(240), index=True)
     filename = Column(String(256))
     track_num = Column(Integer)
     mtime = Column(Integer)
+    # File size and a hash of its contents (see manage.fingerprint()), to
+    # recognize a file that has been moved or renamed.
+    size = Column(Integer)
+    content_hash = Column(String(40))
+    # Audio properties, from Mutagen.
+    duration = Column(Float)  # In seconds.
+    bitrate = Column(Integer)  # In bits per second.
+    sample_rate = Column(Integer)
+    codec = Column(String(16))
     album_id = Column(Integer, ForeignKey('album.id'))
     album = relationship(
         'Album',
         backref=backref('tracks', lazy='dynamic')
     )
 
-    def __init__(self, artist, title, filename, album, track_num, mtime):
+    def __init__(self, artist, title, filename, album, track_num, mtime,
+                 size=None, content_hash=None, duration=None, bitrate=None,
+                 sample_rate=None, codec=None):
         self.artist = artist
         self.title = title
         self.album = album
         self.filename = filename
         self.track_num = track_num
         self.mtime = int(mtime)  # get the floor of given float
+        self.size = size
+        self.content_hash = content_hash
+        self.duration = duration
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.codec = codec
+        self.update_search_keys()
+
+    def update_search_keys(self):
+        self.artist_key = search_key(self.artist)
+        self.title_key = search_key(self.title)
 
     def __repr__(self):
         return u'<Track {0.artist} - {0.title}>'.format(self)
@@ -38,6 +80,10 @@ class Track(db.Model):
             'title': self.title,
             'album': self.album.serialize if self.album else '',
             'track': self.track_num,
+            'duration': self.duration,
+            'bitrate': self.bitrate,
+            'sample_rate': self.sample_rate,
+            'codec': self.codec,
             'id': self.id
         }
 
@@ -48,6 +94,9 @@ class Album(db.Model):
     id = Column(Integer, primary_key=True)
     artist = Column(String(200))
     title = Column(String(240))
+    # Folded with search_key(), for searching and browsing.
+    artist_key = Column(String(200), index=True)
+    title_key = Column(String(240), index=True)
     # TODO: Use a real date format.
     date = Column(String(16))
     label = Column(String(240))
@@ -62,6 +111,11 @@ class Album(db.Model):
         self.label = label
         self.cat_number = cat_number
         self.cover_art = cover_art
+        self.update_search_keys()
+
+    def update_search_keys(self):
+        self.artist_key = search_key(self.artist)
+        self.title_key = search_key(self.title)
 
     def __repr__(self):
         return (
@@ -79,3 +133,324 @@ class Album(db.Model):
             'has_cover_art': self.cover_art is not None,
             'id': self.id
         }
+
+
+class Playlist(db.Model):
+    """ A user's saved play queue or named playlist.
+
+    Entries are ordered by a sparse integer `position` rather than a dense
+    index, so inserting or moving a track only writes that one entry's row.
+    Every change bumps `version` and stamps it on the entries it touched;
+    removed entries are kept as tombstones so a client can ask for
+    everything that changed since the version it last saw. Tombstones are
+    only kept for TOMBSTONE_VERSIONS versions, so that a long-used play
+    queue doesn't get slower with its edit history.
+    """
+    __tablename__ = 'playlist'
+
+    # Spacing between consecutive entry positions. Inserting between two
+    # neighbours takes the midpoint, so roughly log2(POSITION_GAP) inserts
+    # can land in the same spot before the list has to be renumbered.
+    POSITION_GAP = 1 << 16
+
+    # Tombstones older than this many versions are deleted, every
+    # COMPACT_INTERVAL versions. A client further behind than that has to
+    # read the whole playlist again.
+    TOMBSTONE_VERSIONS = 1000
+    COMPACT_INTERVAL = 100
+
+    id = Column(Integer, primary_key=True)
+    owner = Column(String(254), index=True)  # The owning user's ID (email).
+    name = Column(String(240))
+    version = Column(Integer, nullable=False)
+    # Tombstones up to this version have been deleted (see compact()).
+    compacted_version = Column(Integer)
+
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+        self.version = 0
+        self.compacted_version = 0
+
+    def __repr__(self):
+        return u'<Playlist {0.name} ({0.owner})>'.format(self)
+
+    @property
+    def serialize(self):
+        return {
+            'name': self.name,
+            'version': self.version,
+            'length': self.live_entries().count(),
+            'id': self.id
+        }
+
+    def live_entries(self):
+        """ Query for this playlist's entries (minus tombstones), in order.
+        """
+        return (PlaylistEntry.query
+                .filter_by(playlist_id=self.id, removed=False)
+                .order_by(PlaylistEntry.position))
+
+    def entry_range(self, start=0, limit=None):
+        """ Return up to `limit` entries starting at index `start`. """
+        query = self.live_entries().offset(start)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
+    def changes_since(self, version):
+        """ Return all entries, including removed ones, that changed after
+        `version`, in order, or None if tombstones from after `version`
+        have since been deleted. """
+        if version < (self.compacted_version or 0):
+            return None
+        return (PlaylistEntry.query
+                .filter(PlaylistEntry.playlist_id == self.id,
+                        PlaylistEntry.version > version)
+                .order_by(PlaylistEntry.position)
+                .all())
+
+    def insert(self, track, index=None):
+        """ Insert `track` before the entry currently at `index`, or append
+        it if `index` is None or past the end. Returns the new entry. """
+        self._bump_version()
+        entry = PlaylistEntry(self, track, self._position_for(index),
+                              self.version)
+        db.session.add(entry)
+        db.session.flush()
+        return entry
+
+    def move(self, entry, index):
+        """ Move `entry` so that it ends up at `index`. """
+        current = self.index_of(entry)
+        if index == current:
+            return
+        if index > current:
+            # Positions are computed from the list as it is now, with the
+            # moved entry still in place, so step past it.
+            index += 1
+        self._bump_version()
+        entry.position = self._position_for(index)
+        entry.version = self.version
+        db.session.flush()
+
+    def remove(self, entry):
+        """ Remove `entry`, leaving a tombstone for incremental sync. """
+        self._bump_version()
+        entry.removed = True
+        entry.version = self.version
+        self._compact_if_due()
+        db.session.flush()
+
+    def compact(self, horizon):
+        """ Delete the tombstones of entries removed at or before version
+        `horizon`. """
+        (PlaylistEntry.query
+         .filter(PlaylistEntry.playlist_id == self.id,
+                 PlaylistEntry.removed == True,
+                 PlaylistEntry.version <= horizon)
+         .delete(synchronize_session=False))
+        self.compacted_version = max(self.compacted_version or 0, horizon)
+
+    @classmethod
+    def remove_tracks(cls, track_ids):
+        """ Remove all entries for the given tracks (e.g. because they have
+        left the library) from every playlist, bumping each affected
+        playlist's version once. """
+        removed = {}
+        track_ids = list(track_ids)
+        for start in xrange(0, len(track_ids), SQL_CHUNK):
+            entries = PlaylistEntry.query.filter(
+                PlaylistEntry.track_id.in_(
+                    track_ids[start:start + SQL_CHUNK]),
+                PlaylistEntry.removed == False)
+            for entry in entries:
+                removed.setdefault(entry.playlist, []).append(entry)
+
+        for playlist, entries in removed.iteritems():
+            playlist._bump_version()
+            for entry in entries:
+                entry.removed = True
+                entry.version = playlist.version
+            playlist._compact_if_due()
+        db.session.flush()
+
+    def index_of(self, entry):
+        """ Return `entry`'s current index in the playlist. """
+        return (PlaylistEntry.query
+                .filter(PlaylistEntry.playlist_id == self.id,
+                        PlaylistEntry.removed == False,
+                        PlaylistEntry.position < entry.position)
+                .count())
+
+    def _bump_version(self):
+        """ Increment the version in the database and read it back. Doing
+        it in SQL (which also takes the write lock) means two concurrent
+        edits can't both claim the same version. """
+        db.session.flush()
+        Playlist.query.filter_by(id=self.id).update(
+            {Playlist.version: Playlist.version + 1},
+            synchronize_session=False)
+        version = (db.session.query(Playlist.version)
+                   .filter_by(id=self.id).scalar())
+        # Not an in-Python change, so don't write it back on flush.
+        set_committed_value(self, 'version', version)
+
+    def _compact_if_due(self):
+        if (self.version - (self.compacted_version or 0) >=
+                self.TOMBSTONE_VERSIONS + self.COMPACT_INTERVAL):
+            self.compact(self.version - self.TOMBSTONE_VERSIONS)
+
+    def _position_for(self, index):
+        """ Find a free position that sorts just before the entry at `index`
+        (or after the last entry, if `index` is None or past the end),
+        renumbering the playlist if there is no room left there. """
+        if index is not None and index > 0:
+            neighbours = self.live_entries().offset(index - 1).limit(2).all()
+            if len(neighbours) == 2:
+                before, after = neighbours
+                low = before.position
+            else:
+                after = None
+        elif index == 0:
+            after = self.live_entries().first()
+            low = 0
+        else:
+            after = None
+
+        if after is None:
+            last = (db.session.query(func.max(PlaylistEntry.position))
+                    .filter_by(playlist_id=self.id, removed=False)
+                    .scalar())
+            return (last or 0) + self.POSITION_GAP
+
+        if after.position - low > 1:
+            return low + (after.position - low) // 2
+
+        self._renumber()
+        return self._position_for(index)
+
+    def _renumber(self):
+        """ Spread entries out evenly again. This rewrites every entry, but
+        it only happens after many inserts into the same spot. """
+        for i, entry in enumerate(self.live_entries().all()):
+            entry.position = (i + 1) * self.POSITION_GAP
+            entry.version = self.version
+        db.session.flush()
+
+
+class PlaylistEntry(db.Model):
+    __tablename__ = 'playlist_entry'
+    __table_args__ = (
+        Index('ix_playlist_entry_position', 'playlist_id', 'position'),
+        Index('ix_playlist_entry_version', 'playlist_id', 'version'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    playlist_id = Column(Integer, ForeignKey('playlist.id'), nullable=False)
+    playlist = relationship(
+        'Playlist',
+        backref=backref('entries', lazy='dynamic')
+    )
+    track_id = Column(Integer, ForeignKey('track.id'))
+    track = relationship('Track')
+    position = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False)
+    removed = Column(Boolean, nullable=False, default=False)
+
+    def __init__(self, playlist, track, position, version):
+        self.playlist = playlist
+        self.track = track
+        self.position = position
+        self.version = version
+        self.removed = False
+
+    def __repr__(self):
+        return u'<PlaylistEntry {0.position}: {0.track}>'.format(self)
+
+    @property
+    def serialize(self):
+        return {
+            'position': self.position,
+            'version': self.version,
+            'removed': self.removed,
+            'track': (self.track.serialize
+                      if self.track and not self.removed else None),
+            'id': self.id
+        }
+
+
+class PlayEvent(db.Model):
+    """ One entry in the append-only play history. Rows are only ever
+    inserted (in batches, by history.PlayLog), never updated, except that
+    `track_id` is cleared when the track leaves the library. """
+    __tablename__ = 'play_event'
+    __table_args__ = (
+        Index('ix_play_event_user', 'user', 'id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user = Column(String(254))
+    track_id = Column(Integer, ForeignKey('track.id'))
+    track = relationship('Track')
+    played_at = Column(Integer)  # Unix time.
+
+    def __init__(self, user, track_id, played_at):
+        self.user = user
+        self.track_id = track_id
+        self.played_at = int(played_at)
+
+    def __repr__(self):
+        return u'<PlayEvent {0.track_id} at {0.played_at}>'.format(self)
+
+    @property
+    def serialize(self):
+        return {
+            'track': self.track.serialize if self.track else None,
+            'played_at': self.played_at,
+            'id': self.id
+        }
+
+
+class PlayCount(db.Model):
+    """ Rolled-up play totals, so stats don't have to scan the history.
+    `kind` is one of PlayCount.KINDS; `key` is a track or album ID, an
+    artist name, or a day in YYYY-MM-DD form, respectively. """
+    __tablename__ = 'play_count'
+    __table_args__ = (
+        Index('ix_play_count_key', 'kind', 'key', unique=True),
+        Index('ix_play_count_plays', 'kind', 'plays'),
+    )
+
+    KINDS = ('track', 'album', 'artist', 'day')
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(8), nullable=False)
+    key = Column(String(200), nullable=False)
+    plays = Column(Integer, nullable=False)
+    last_played = Column(Integer)
+
+    def __init__(self, kind, key, plays=0, last_played=None):
+        self.kind = kind
+        self.key = key
+        self.plays = plays
+        self.last_played = last_played
+
+    def __repr__(self):
+        return u'<PlayCount {0.kind} {0.key}: {0.plays}>'.format(self)
+
+
+class Library(db.Model):
+    """ A single row holding a counter that update_db() bumps whenever the
+    music library changes, so running servers can tell when to refresh
+    anything they have built from it. """
+    __tablename__ = 'library'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+    def __init__(self, version=0):
+        self.version = version
+
+    def __repr__(self):
+        return u'<Library version {0.version}>'.format(self)
@@ -5,12 +5,16 @@ import re
 import sys
 from subprocess import Popen, PIPE
 from flask import (Flask, request, render_template, jsonify, abort, redirect,
-                   Response, url_for)
+                   Response, send_file, url_for)
 from flask.ext.login import (LoginManager, UserMixin, current_user,
                              login_required, login_user)
 from flask.ext.browserid import BrowserID
 from wsgi_utils import PipeWrapper
-from models import Track, Album, db
+from models import (Track, Album, Playlist, PlaylistEntry, PlayEvent,
+                    PlayCount, search_key, db)
+from history import PlayLog
+from search_index import SearchEngine, tokenize, has_prefixes
+import transcode
 
 app = Flask(__name__)
 db.init_app(app)
@@ -22,6 +26,11 @@ app.config.update(
     SQLALCHEMY_DATABASE_URI=(os.environ.get('DB_URI', 'sqlite:///tracks.db')),
     MUSIC_DIR=(os.environ.get('MUSIC_DIR', 'static/music')),
     ADMIN_EMAIL=(os.environ.get('ADMIN_EMAIL', None)),
+    SEARCH_INDEX=(True if os.environ.get('SEARCH_INDEX') in ['1', 'True']
+                  else False),
+    SEARCH_INDEX_MAX_MB=int(os.environ.get('SEARCH_INDEX_MAX_MB', 128)),
+    TRANSCODE_PROFILES=(os.environ.get('TRANSCODE_PROFILES', '')),
+    TRANSCODE_CACHE_DIR=(os.environ.get('TRANSCODE_CACHE_DIR', None)),
     SEND_FILE_MAX_AGE_DEFAULT=10
 )
 
@@ -69,6 +78,59 @@ browser_id = BrowserID()
 browser_id.user_loader(get_user)
 browser_id.init_app(app)
 
+play_log = PlayLog()
+play_log.init_app(app)
+
+transcode_profiles = transcode.enabled_profiles(
+    app.config['TRANSCODE_PROFILES'])
+
+search_engine = None
+if app.config['SEARCH_INDEX']:
+    search_engine = SearchEngine(
+        max_memory_mb=app.config['SEARCH_INDEX_MAX_MB'])
+    search_engine.init_app(app)
+
+
+def get_by_ids(model, ids):
+    """ Fetch the rows of `model` with the given IDs, in the same order.
+    """
+    if not ids:
+        return []
+    found = dict((o.id, o) for o in model.query.filter(model.id.in_(ids)))
+    return [found[i] for i in ids if i in found]
+
+
+def non_negative(value):
+    """ Return `value` (an int request argument, or None), aborting with a
+    400 if it's negative. """
+    if value is not None and value < 0:
+        abort(400)
+    return value
+
+
+def search_database(model, tokens, limit):
+    """ Search `model`'s table for up to `limit` rows matching all the
+    given tokens the way the search index would (as word prefixes), so
+    that results don't change when the index becomes ready. Tokens with no
+    words in them (just punctuation) are matched as substrings instead.
+    """
+    prefixes = [word for token in tokens for word in tokenize(token)]
+    # Narrow it down to substring matches in SQL, then check for words.
+    filters = [model.title_key.contains(token) |
+               model.artist_key.contains(token)
+               for token in tokens if not tokenize(token)]
+    filters += [model.title_key.contains(prefix) |
+                model.artist_key.contains(prefix) for prefix in prefixes]
+
+    found = []
+    for row in (model.query.filter(*filters).order_by(model.id)
+                .yield_per(100)):
+        if has_prefixes(u'{0} {1}'.format(row.title, row.artist), prefixes):
+            found.append(row)
+            if len(found) >= limit:
+                break
+    return found
+
 
 @app.route('/search')
 @login_required
@@ -77,16 +139,19 @@ def search_results():
     search_term = request.args.get('q', '')
 
     # split search term into up to 10 tokens (anything further is ignored)
-    tokens = filter(None, re.split('\s+', search_term))[:10]
-
-    filters = [Track.title.contains(token) | Track.artist.contains(token)
-               for token in tokens]
-    tracks = Track.query.filter(*filters).limit(30).all()
-
-    album_filters = [Album.title.contains(token) |
-                     Album.artist.contains(token) for token in tokens]
-    albums = Album.query.filter(*album_filters).limit(10).all()
-
+    tokens = filter(None, re.split('\s+', search_key(search_term)))[:10]
+
+    # Use the in-memory index if it's enabled and ready; then only the
+    # matching rows need to be fetched, by primary key.
+    found = search_engine and search_engine.search(tokens, 30, 10)
+    if found is not None:
+        album_ids, track_ids = found
+        albums = get_by_ids(Album, album_ids)
+        tracks = get_by_ids(Track, track_ids)
+        return jsonify(objects=[t.serialize for t in (albums + tracks)])
+
+    albums = search_database(Album, tokens, 10)
+    tracks = search_database(Track, tokens, 30)
     return jsonify(objects=[t.serialize for t in (albums + tracks)])
 
 
@@ -96,12 +161,15 @@ def get_artists():
     # Return artists lexicographically after 'start', if provided.
     # TODO: Come up with a solution for artists who only have non-album
     # tracks. For now, this only returns artists who have albums.
-    start = request.args.get('start', '')
+    # Artists are compared by search key, so spellings that differ only in
+    # case or accents are listed once, and sorted together.
+    start = search_key(request.args.get('start', ''))
 
     limit = request.args.get('limit', 30)
 
-    albums = (Album.query.filter(Album.artist > start).group_by(Album.artist)
-              .order_by(Album.artist).limit(limit)).all()
+    albums = (Album.query.filter(Album.artist_key > start)
+              .group_by(Album.artist_key)
+              .order_by(Album.artist_key).limit(limit)).all()
     return jsonify(objects=[a.artist for a in albums])
 
 
@@ -110,8 +178,8 @@ def get_artists():
 def get_artist_albums(artist):
     # Return a list of an artist's albums.
     # TODO: Come up with a solution for surfacing non-album tracks as well.
-    albums = (Album.query.filter(Album.artist == artist)
-              .order_by(Album.title).order_by(Album.date))
+    albums = (Album.query.filter(Album.artist_key == search_key(artist))
+              .order_by(Album.title_key).order_by(Album.date))
     return jsonify(objects=[a.serialize for a in albums])
 
 
@@ -156,37 +224,248 @@ def get_track_audio(track_id, wanted_formats):
     """ Get a track's audio.
     If `wanted_formats` (a comma-separated list) includes the file's actual
     format, a redirect is sent (so the static file can be handled as such).
-    Otherwise, if `wanted_formats` includes ogg, it's transcoded on the fly.
+    Otherwise it's transcoded on the fly, using the transcoding profile in
+    one of `wanted_formats` that best fits the client's hints.
+
+    The hints are `quality` (low, medium or high) and `max_bitrate` (in
+    kbps). A playable track above the hinted bitrate is also transcoded,
+    if some profile would make it smaller.
     """
 
-    TRANSCODABLE_FORMATS = ['mp3', 'ogg', 'flac', 'm4a', 'wav']
     wanted_formats = re.split(',', wanted_formats)
+    target = transcode.target_bitrate(
+        request.args.get('quality'),
+        request.args.get('max_bitrate', type=int))
 
     track = Track.query.filter_by(id=track_id).first()
     if track is None:
         abort(404)
 
     actual_format = re.search('\.([^.]+)$', track.filename).group(1)
-    if actual_format in wanted_formats:
-        # No need to transcode. Just redirect to the static file.
-        return redirect(os.path.join('/' + app.config['MUSIC_DIR'],
-                                     track.filename))
+    profile = None
+    if actual_format in transcode.TRANSCODABLE_FORMATS:
+        # Never aim above the source's own bitrate.
+        bitrate = (target or
+                   transcode.QUALITY_BITRATES[transcode.DEFAULT_QUALITY])
+        if track.bitrate:
+            bitrate = min(bitrate, track.bitrate)
+        profile = transcode.choose_profile(transcode_profiles,
+                                           wanted_formats, bitrate)
 
-    if (actual_format not in TRANSCODABLE_FORMATS
-            or 'ogg' not in wanted_formats):
-        # Can't transcode this. We only go from TRANSCODABLE_FORMATS to ogg.
+    if actual_format in wanted_formats:
+        too_big = (target is not None and track.bitrate is not None and
+                   track.bitrate > target)
+        if not (too_big and profile and profile.bitrate < track.bitrate):
+            # No need to transcode. Just redirect to the static file.
+            return redirect(os.path.join('/' + app.config['MUSIC_DIR'],
+                                         track.filename))
+
+    if profile is None:
+        # Can't transcode this: it's not in TRANSCODABLE_FORMATS, or no
+        # profile produces a wanted format.
         abort(404)
 
-    # Transcode to ogg.
+    cache_filename = None
+    if app.config['TRANSCODE_CACHE_DIR']:
+        cache_filename = profile.cache_filename(
+            app.config['TRANSCODE_CACHE_DIR'], track)
+        if os.path.exists(cache_filename):
+            response = send_file(cache_filename, mimetype=profile.mimetype,
+                                 conditional=True)
+            if track.duration:
+                # As below, so the seek bar is the same as on the first
+                # play; the real Content-Length is known this time.
+                response.headers['X-Content-Duration'] = \
+                    '{0:.2f}'.format(track.duration)
+            return response
+        transcode.prepare_cache(cache_filename, track)
+
     # Note that track.filename came out of the DB and is *not* user-specified
     # (through the web interface), so can be trusted.
-    command = ['avconv', '-v', 'quiet',
-               '-i', os.path.join(app.config['MUSIC_DIR'], track.filename),
-               '-f', 'ogg', '-acodec', 'libvorbis', '-aq', '5', '-']
+    command = profile.command(
+        os.path.join(app.config['MUSIC_DIR'], track.filename))
     pipe = Popen(command, stdout=PIPE)
 
-    return Response(PipeWrapper(pipe),
-                    mimetype='audio/ogg', direct_passthrough=True)
+    response = Response(PipeWrapper(pipe, cache_filename=cache_filename),
+                        mimetype=profile.mimetype, direct_passthrough=True)
+    if track.duration:
+        # The output is VBR, so its exact length isn't known in advance and
+        # no Content-Length can be sent. The duration (which Firefox uses to
+        # show a seek bar for streamed audio) and a size estimate can be.
+        response.headers['X-Content-Duration'] = \
+            '{0:.2f}'.format(track.duration)
+        response.headers['X-Estimated-Content-Length'] = \
+            str(profile.estimated_size(track))
+    return response
+
+
+@app.route('/song/<int:track_id>/played', methods=['POST'])
+@login_required
+def track_played(track_id):
+    """ Beacon sent by the client when a track has been played. The event
+    is buffered and written to the play history in a later batch. """
+    play_log.record(current_user.user_id, track_id)
+    return ('', 204)
+
+
+@app.route('/history')
+@login_required
+def recently_played():
+    """ Return the current user's most recently played tracks. """
+    play_log.flush()
+    limit = min(non_negative(request.args.get('limit', 30, type=int)), 200)
+    events = (PlayEvent.query.filter_by(user=current_user.user_id)
+              .order_by(PlayEvent.id.desc()).limit(limit))
+    return jsonify(objects=[e.serialize for e in events])
+
+
+@app.route('/stats/<kind>')
+@login_required
+def play_stats(kind):
+    """ Return the most played tracks, albums or artists, or the play count
+    for each of the most recent days, from the rolled-up totals. """
+    if kind not in PlayCount.KINDS:
+        abort(404)
+    play_log.flush()
+    limit = min(non_negative(request.args.get('limit', 30, type=int)), 200)
+
+    counts = PlayCount.query.filter_by(kind=kind)
+    if kind == 'day':
+        counts = counts.order_by(PlayCount.key.desc())
+    else:
+        counts = counts.order_by(PlayCount.plays.desc())
+    counts = counts.limit(limit).all()
+
+    if kind in ('track', 'album'):
+        model = Track if kind == 'track' else Album
+        ids = [int(c.key) for c in counts]
+        found = dict((o.id, o) for o in
+                     model.query.filter(model.id.in_(ids)).all())
+        objects = []
+        for count in counts:
+            if int(count.key) not in found:
+                continue  # Removed from the library since.
+            info = found[int(count.key)].serialize
+            info['plays'] = count.plays
+            objects.append(info)
+    else:
+        objects = [{kind: c.key, 'plays': c.plays} for c in counts]
+
+    return jsonify(objects=objects)
+
+
+def get_own_playlist(playlist_id):
+    """ Return the current user's playlist with the given ID, or abort with
+    a 404 if there isn't one. """
+    playlist = Playlist.query.filter_by(id=playlist_id,
+                                        owner=current_user.user_id).first()
+    if playlist is None:
+        abort(404)
+    return playlist
+
+
+def get_playlist_entry(playlist, entry_id):
+    entry = PlaylistEntry.query.filter_by(id=entry_id,
+                                          playlist_id=playlist.id,
+                                          removed=False).first()
+    if entry is None:
+        abort(404)
+    return entry
+
+
+@app.route('/playlist', methods=['GET', 'POST'])
+@login_required
+def user_playlists():
+    """ List the current user's playlists, or create a new one from the
+    `name` form field. """
+    if request.method == 'POST':
+        playlist = Playlist(current_user.user_id,
+                            request.form.get('name', 'Play queue'))
+        db.session.add(playlist)
+        db.session.commit()
+        return jsonify(playlist.serialize)
+
+    playlists = (Playlist.query.filter_by(owner=current_user.user_id)
+                 .order_by(Playlist.id))
+    return jsonify(objects=[p.serialize for p in playlists])
+
+
+@app.route('/playlist/<int:playlist_id>', methods=['GET', 'DELETE'])
+@login_required
+def playlist_info(playlist_id):
+    playlist = get_own_playlist(playlist_id)
+    if request.method == 'DELETE':
+        playlist.entries.delete()
+        db.session.delete(playlist)
+        db.session.commit()
+        return jsonify(id=playlist_id)
+    return jsonify(playlist.serialize)
+
+
+@app.route('/playlist/<int:playlist_id>/entries', methods=['GET', 'POST'])
+@login_required
+def playlist_entries(playlist_id):
+    """ Read a range of a playlist's entries (`start` and `limit` query
+    args), or insert the track given by the `track_id` form field. It goes
+    before the entry at `index` if given, otherwise at the end. """
+    playlist = get_own_playlist(playlist_id)
+
+    if request.method == 'POST':
+        track = Track.query.filter_by(
+            id=request.form.get('track_id', type=int)).first()
+        if track is None:
+            abort(404)
+        entry = playlist.insert(
+            track, non_negative(request.form.get('index', type=int)))
+        db.session.commit()
+        return jsonify(version=playlist.version, entry=entry.serialize)
+
+    start = non_negative(request.args.get('start', 0, type=int))
+    limit = min(non_negative(request.args.get('limit', 100, type=int)), 1000)
+    entries = playlist.entry_range(start, limit)
+    return jsonify(version=playlist.version, start=start,
+                   objects=[e.serialize for e in entries])
+
+
+@app.route('/playlist/<int:playlist_id>/entries/<int:entry_id>',
+           methods=['DELETE'])
+@login_required
+def remove_playlist_entry(playlist_id, entry_id):
+    playlist = get_own_playlist(playlist_id)
+    playlist.remove(get_playlist_entry(playlist, entry_id))
+    db.session.commit()
+    return jsonify(version=playlist.version)
+
+
+@app.route('/playlist/<int:playlist_id>/entries/<int:entry_id>/move',
+           methods=['POST'])
+@login_required
+def move_playlist_entry(playlist_id, entry_id):
+    """ Move an entry to the index given by the `index` form field. """
+    playlist = get_own_playlist(playlist_id)
+    entry = get_playlist_entry(playlist, entry_id)
+    index = non_negative(request.form.get('index', type=int))
+    if index is None:
+        abort(400)
+    playlist.move(entry, index)
+    db.session.commit()
+    return jsonify(version=playlist.version, entry=entry.serialize)
+
+
+@app.route('/playlist/<int:playlist_id>/changes')
+@login_required
+def playlist_changes(playlist_id):
+    """ Return every entry (including removed ones) that changed after the
+    version given in `since`, so a client can patch its copy instead of
+    re-reading the whole playlist. If `since` is too old for that, the
+    response just has `resync` set, and the client has to re-read it. """
+    playlist = get_own_playlist(playlist_id)
+    since = request.args.get('since', 0, type=int)
+    entries = playlist.changes_since(since)
+    if entries is None:
+        return jsonify(version=playlist.version, resync=True)
+    return jsonify(version=playlist.version,
+                   objects=[e.serialize for e in entries])
 
 
 @app.route('/')
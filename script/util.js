@@ -7,6 +7,7 @@ function detectFormats() {
     var mimetypes = {  // maps file extensions to mime types
         m4a: 'audio/mp4',
         ogg: 'audio/ogg',
+        opus: 'audio/ogg; codecs="opus"',
         mp3: 'audio/mpeg'
     };
     return _.keys(mimetypes).filter(
@@ -21,3 +22,17 @@ exports.supportedFormats = function() {
         formats = detectFormats();
     return formats;
 };
+
+exports.qualityHint = function() {
+    // Returns a "quality" hint for the server's transcoder: "low" on a
+    // cellular connection (where the browser can tell), otherwise "".
+    var connection = navigator.connection;
+    return (connection && connection.type === 'cellular') ? 'low' : '';
+};
+
+exports.formatDuration = function(seconds) {
+    // Formats a duration in seconds as e.g. "3:07".
+    seconds = Math.round(seconds);
+    var secs = seconds % 60;
+    return Math.floor(seconds / 60) + ':' + (secs < 10 ? '0' : '') + secs;
+};
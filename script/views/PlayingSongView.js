@@ -36,6 +36,9 @@ var PlayingSongView = React.createBackboneClass({
 
         var wantedFormats = util.supportedFormats();
         var filename = '/song/' + songId + '/' + wantedFormats;
+        var quality = util.qualityHint();
+        if (quality)
+            filename += '?quality=' + quality;
         var isPlaying = true; // FIXME: not reactive, copied from Backbone view
 
         return (
@@ -70,8 +73,13 @@ var PlayingSongView = React.createBackboneClass({
         var audioSel = $('audio', rootNode);
         audioSel.trigger('play');
 
-        // Set up handler to move to next song when song finished.
+        // Set up handler to move to next song when song finished,
+        // after telling the server the song was played.
+        var songId = this.getModel().get('id');
         audioSel.off('ended');
+        audioSel.on('ended', function() {
+            $.post('/song/' + songId + '/played');
+        });
         audioSel.on('ended', this.props.nextSongHandler);
 
         // update the cover art
@@ -3,7 +3,8 @@
 
 var _ = require('underscore'),
     Backbone = require('backbone'),
-    React = require('react');
+    React = require('react'),
+    util = require('../util');
 
 var PlaylistItemView = React.createBackboneClass({
     render: function() {
@@ -27,6 +28,11 @@ var PlaylistItemView = React.createBackboneClass({
                 {' — '}
                 <span onClick={clickHandler}
                       className="song-name">{m.get('title')}</span>
+                {m.get('duration') ?
+                    <span className="song-duration">
+                        {' (' + util.formatDuration(m.get('duration')) + ')'}
+                    </span>
+                    : ''}
             </li>
         );
     }
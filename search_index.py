@@ -0,0 +1,377 @@
+import heapq
+import operator
+import re
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from sqlalchemy.exc import OperationalError
+from models import Track, Album, Library, search_key, db
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+NONZERO_DIGIT_RE = re.compile('[1-9a-f]')
+
+# Library version of an index that hasn't been (successfully) built yet.
+UNBUILT = object()
+
+# Rough memory per indexed track or album, measured on a synthetic library
+# of 500k tracks (65 MB), for deciding whether an index will fit before
+# building it.
+BYTES_PER_ROW = 140
+
+
+def lowest_bits(bits, limit):
+    """ Return the positions of up to `limit` of the lowest set bits in
+    `bits`, in increasing order. """
+    found = []
+    # Scan the hex digits from the least significant end; going through a
+    # string is much faster than shifting a large long bit by bit.
+    digits = '%x' % bits
+    for match in NONZERO_DIGIT_RE.finditer(digits[::-1]):
+        digit = int(match.group(), 16)
+        for bit in xrange(4):
+            if digit & (1 << bit):
+                found.append(match.start() * 4 + bit)
+                if len(found) >= limit:
+                    return found
+    return found
+
+
+def tokenize(text):
+    """ Split `text` into the words that get indexed, folded with
+    search_key(). """
+    if not text:
+        return []
+    return TOKEN_RE.findall(search_key(text))
+
+
+def has_prefixes(text, prefixes):
+    """ Whether `text` has, for each of `prefixes`, a word starting with it;
+    that is, whether a PrefixIndex search would find it. """
+    words = tokenize(text)
+    return all(any(word.startswith(prefix) for word in words)
+               for prefix in prefixes)
+
+
+class PrefixIndex(object):
+    """ An immutable word-prefix index over a set of documents.
+
+    Everything is stored in flat arrays rather than per-document objects:
+    the sorted vocabulary, each word's posting list (the documents that
+    contain it), and each document's word IDs. Because the vocabulary is
+    sorted, the words starting with a given prefix form a contiguous range
+    of word IDs, found by bisection. Prefixes that match many documents
+    also get a bitmap, so that queries made of common words don't have to
+    walk their long posting lists.
+
+    Memory use is roughly 16 bytes per (document, distinct word) pair plus
+    the vocabulary strings and the bitmaps (a few MB at 500k documents),
+    and building needs little more than that; see SearchEngine for the
+    overall budget.
+    """
+
+    # Prefixes matching at least 1/DENSE_FRACTION of the documents (and
+    # MIN_DENSE_POSTINGS) get a bitmap, costing 1/8 byte per document each.
+    DENSE_FRACTION = 50
+    MIN_DENSE_POSTINGS = 1000
+
+    # Above this many candidates, search() checks them against the bitmaps
+    # all at once rather than one by one.
+    CHECK_LIMIT = 1000
+
+    def __init__(self, docs):
+        """ `docs` is an iterable of (row ID, text) pairs. """
+        self.row_ids = array('l')
+
+        # Each document's word IDs, concatenated: document i's words are
+        # doc_word_ids[word_starts[i]:word_starts[i + 1]]. Words are first
+        # numbered as they're seen, to avoid holding every document's words
+        # as strings; they're renumbered in sorted order below.
+        self.word_starts = array('l', [0])
+        self.doc_word_ids = array('l')
+        word_ids = {}
+        for row_id, text in docs:
+            self.row_ids.append(row_id)
+            for w in set(tokenize(text)):
+                word = word_ids.setdefault(w, len(word_ids))
+                self.doc_word_ids.append(word)
+            self.word_starts.append(len(self.doc_word_ids))
+
+        self.vocab = sorted(word_ids)
+        renumber = array('l', [0]) * len(self.vocab)
+        for i, w in enumerate(self.vocab):
+            renumber[word_ids[w]] = i
+        del word_ids
+        counts = array('l', [0]) * len(self.vocab)
+        for i, word in enumerate(self.doc_word_ids):
+            self.doc_word_ids[i] = renumber[word]
+            counts[renumber[word]] += 1
+        del renumber
+        # Sort each document's words, so has_word() can bisect them.
+        for doc in xrange(len(self.row_ids)):
+            start, end = self.word_starts[doc], self.word_starts[doc + 1]
+            if end - start > 1:
+                self.doc_word_ids[start:end] = array(
+                    'l', sorted(self.doc_word_ids[start:end]))
+
+        # Posting lists, concatenated likewise: word i's documents are
+        # postings[posting_starts[i]:posting_starts[i + 1]].
+        self.posting_starts = array('l', [0])
+        for count in counts:
+            self.posting_starts.append(self.posting_starts[-1] + count)
+        del counts
+        self.postings = array('l', [0]) * self.posting_starts[-1]
+        fill = array('l', self.posting_starts[:-1])
+        for doc in xrange(len(self.row_ids)):
+            for word in self.doc_word_ids[self.word_starts[doc]:
+                                          self.word_starts[doc + 1]]:
+                self.postings[fill[word]] = doc
+                fill[word] += 1
+        del fill
+
+        # Bitmaps (as longs, with bit i set for document i) of the prefixes
+        # that match many documents, so that searching for several of them
+        # is a few ANDs instead of a walk through their postings.
+        self.dense_postings = max(len(self.row_ids) // self.DENSE_FRACTION,
+                                  self.MIN_DENSE_POSTINGS)
+        self.bitmaps = {}
+        prefixes = [(u'', 0, len(self.vocab))]
+        while prefixes:
+            prefix, start, end = prefixes.pop()
+            if start < end and self.vocab[start] == prefix:
+                start += 1
+            while start < end:
+                # The next longer prefix, and the words starting with it.
+                longer = self.vocab[start][:len(prefix) + 1]
+                longer_end = self.prefix_range(longer)[1]
+                postings = self.prefix_postings(start, longer_end)
+                if len(postings) >= self.dense_postings:
+                    self.bitmaps[longer] = self.to_bitmap(postings)
+                    prefixes.append((longer, start, longer_end))
+                start = longer_end
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def prefix_range(self, prefix):
+        """ Return the (start, end) range of word IDs starting with
+        `prefix`. """
+        start = bisect_left(self.vocab, prefix)
+        after = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+        return start, bisect_left(self.vocab, after, start)
+
+    def prefix_postings(self, start, end):
+        """ Return the postings of the words with IDs in [start, end), one
+        after another; a document with several of the words is repeated.
+        """
+        return self.postings[self.posting_starts[start]:
+                             self.posting_starts[end]]
+
+    def has_word(self, doc, start, end):
+        """ Whether document `doc` has a word with an ID in [start, end).
+        """
+        last = self.word_starts[doc + 1]
+        i = bisect_left(self.doc_word_ids, start, self.word_starts[doc], last)
+        return i < last and self.doc_word_ids[i] < end
+
+    def to_bitmap(self, docs):
+        """ Return a bitmap of the documents in `docs`. """
+        bits = bytearray(len(self.row_ids) // 8 + 1)
+        for doc in docs:
+            bits[doc >> 3] |= 1 << (doc & 7)
+        bits.reverse()
+        return int(str(bits).encode('hex'), 16)
+
+    def search(self, prefixes, limit):
+        """ Return up to `limit` row IDs of documents that have, for each
+        of `prefixes`, a word starting with it, in the order the documents
+        were given. """
+        if not prefixes:
+            return list(self.row_ids[:limit])
+
+        ranges = [self.prefix_range(p) for p in prefixes]
+        if any(start == end for start, end in ranges):
+            return []
+
+        # Prefixes without a bitmap each match fewer than `dense_postings`
+        # documents, so intersecting their postings as sets is quick, and
+        # leaves at most that many candidates to check against the rest.
+        dense = [(p, r) for p, r in zip(prefixes, ranges)
+                 if p in self.bitmaps]
+        sparse = sorted((r for p, r in zip(prefixes, ranges)
+                         if p not in self.bitmaps),
+                        key=lambda r: self.posting_starts[r[1]] -
+                        self.posting_starts[r[0]])
+        if not sparse:
+            bits = reduce(operator.and_, (self.bitmaps[p] for p, _ in dense))
+            return [self.row_ids[doc] for doc in lowest_bits(bits, limit)]
+
+        docs = self.prefix_postings(*sparse[0])
+        if len(sparse) > 1:
+            docs = set(docs)
+            for start, end in sparse[1:]:
+                docs.intersection_update(self.prefix_postings(start, end))
+        if not dense:
+            found = heapq.nsmallest(limit, set(docs))
+        elif len(docs) > self.CHECK_LIMIT:
+            bits = self.to_bitmap(docs)
+            for prefix, _ in dense:
+                bits &= self.bitmaps[prefix]
+            found = lowest_bits(bits, limit)
+        else:
+            found = []
+            for doc in sorted(set(docs)):
+                if all(self.has_word(doc, start, end)
+                       for _, (start, end) in dense):
+                    found.append(doc)
+                    if len(found) >= limit:
+                        break
+        return [self.row_ids[doc] for doc in found]
+
+    def memory_size(self):
+        """ Approximate memory used, in bytes. """
+        arrays = (self.row_ids, self.posting_starts, self.postings,
+                  self.word_starts, self.doc_word_ids)
+        return (sum(a.itemsize * len(a) for a in arrays) +
+                sys.getsizeof(self.vocab) +
+                sum(sys.getsizeof(w) for w in self.vocab) +
+                sys.getsizeof(self.bitmaps) +
+                sum(sys.getsizeof(p) + sys.getsizeof(b)
+                    for p, b in self.bitmaps.iteritems()))
+
+
+class SearchEngine(object):
+    """ Keeps in-memory PrefixIndexes of the track and album tables so that
+    searches don't have to scan the database.
+
+    The indexes are built in a background thread on the first search (not
+    at import, so `manage.py` commands don't build them), and rebuilt the
+    same way when update_db() bumps the library version (checked at most
+    every `refresh_interval` seconds). Until an index is ready, and if
+    it would exceed `max_memory_mb`, search() returns None and callers
+    should fall back to querying the database.
+
+    `max_memory_mb` bounds the indexes' memory use, including while they
+    are rebuilt: the size is estimated from the row counts beforehand, and
+    if the old and new indexes won't both fit, the old one is dropped (and
+    the database searched) until the new one is ready. At 500k tracks the
+    indexes take around 65 MB (building them peaks only slightly higher),
+    and a query takes about a millisecond, or up to 4 ms for a mix of
+    common and uncommon words.
+    """
+
+    def __init__(self, app=None, refresh_interval=10, max_memory_mb=128):
+        self.refresh_interval = refresh_interval
+        self.max_memory_mb = max_memory_mb
+        self.tracks = None
+        self.albums = None
+        self.version = UNBUILT
+        self._building = False
+        self._lock = threading.Lock()
+        self._last_check = 0
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+
+    def search(self, tokens, track_limit, album_limit):
+        """ Return a pair of lists (album IDs, track IDs) matching all the
+        given tokens as word prefixes, or None if no index is available or
+        the tokens can't be searched for with it.
+        """
+        self._check_version()
+        tracks, albums = self.tracks, self.albums
+        if tracks is None or albums is None:
+            return None
+        words = [tokenize(token) for token in tokens]
+        if not all(words):
+            # A token of nothing but punctuation (e.g. the band "!!!"),
+            # which isn't indexed; the database can still match it.
+            return None
+        prefixes = [word for token_words in words for word in token_words]
+        return (albums.search(prefixes, album_limit),
+                tracks.search(prefixes, track_limit))
+
+    def rebuild(self):
+        """ Build fresh indexes from the database, then swap them in. This
+        needs an application context. """
+        version = db.session.query(Library.version).scalar()
+        budget = self.max_memory_mb * 1024 * 1024
+
+        # Check the likely size first, rather than building an index only
+        # to find it's too big. The old index is still in use while the
+        # new one is built, so if both won't fit, drop it now.
+        rows = Track.query.count() + Album.query.count()
+        if rows * BYTES_PER_ROW > budget:
+            self._over_budget(rows * BYTES_PER_ROW)
+            self.tracks = self.albums = None
+            self.version = version
+            return
+        if rows * BYTES_PER_ROW + self.memory_size() > budget:
+            self.tracks = self.albums = None
+
+        tracks = PrefixIndex(
+            (row.id, u'{0} {1}'.format(row.title, row.artist))
+            for row in db.session.query(Track.id, Track.title, Track.artist)
+            .order_by(Track.id).yield_per(1000))
+        albums = PrefixIndex(
+            (row.id, u'{0} {1}'.format(row.title, row.artist))
+            for row in db.session.query(Album.id, Album.title, Album.artist)
+            .order_by(Album.id).yield_per(1000))
+
+        size = tracks.memory_size() + albums.memory_size()
+        if size > budget:
+            self._over_budget(size)
+            tracks = albums = None
+
+        self.tracks, self.albums = tracks, albums
+        self.version = version
+
+    def memory_size(self):
+        """ Approximate memory used by the current indexes, in bytes. """
+        return sum(index.memory_size()
+                   for index in (self.tracks, self.albums)
+                   if index is not None)
+
+    def _over_budget(self, size):
+        sys.stderr.write(
+            u'Search index needs {0} MB, over the {1} MB limit; '
+            u'searching the database instead.\n'
+            .format(size // (1024 * 1024), self.max_memory_mb))
+
+    def _check_version(self):
+        now = time.time()
+        if self._building or now - self._last_check < self.refresh_interval:
+            return
+        self._last_check = now
+        try:
+            version = db.session.query(Library.version).scalar()
+        except OperationalError:
+            # No library table yet; `manage.py update` hasn't been run.
+            db.session.rollback()
+            return
+        if version != self.version:
+            self._start_rebuild()
+
+    def _start_rebuild(self):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+        thread = threading.Thread(target=self._rebuild_in_context)
+        thread.daemon = True
+        thread.start()
+
+    def _rebuild_in_context(self):
+        try:
+            with self.app.app_context():
+                self.rebuild()
+                db.session.remove()
+        except Exception as e:
+            sys.stderr.write(u'Could not build search index: {0}\n'
+                             .format(e))
+        finally:
+            self._building = False
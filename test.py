@@ -6,8 +6,15 @@ from flask import Flask
 from flask.ext.testing import TestCase
 import unittest
 import time
-from models import db, Track, Album
+from models import (db, Track, Album, Playlist, PlayEvent, PlayCount,
+                    Library, search_key)
+from history import PlayLog, rebuild_rollups
+from search_index import PrefixIndex, SearchEngine
+from StringIO import StringIO
+from wsgi_utils import PipeWrapper
+import transcode
 from manage import update_db
+from potsfyi import search_database
 
 # relative location to where the mock tracks will be written
 TRACK_DIR = 'test/tracks/'
@@ -86,6 +93,16 @@ class TestTagging(TaggingTest):
 
         assert filenames_unique(tracks_in_db)
 
+    def test_audio_properties(self):
+        """ Duration, bitrate, sample rate and codec are recorded. """
+        update_db(TRACK_DIR)
+        track = Track.query.filter_by(filename='foo.mp3').one()
+        assert 29 < track.duration < 31
+        assert track.bitrate > 0
+        assert track.sample_rate == 44100
+        assert track.codec == 'mp3'
+        assert track.serialize['duration'] == track.duration
+
     def test_non_album(self):
         """ Album objects aren't created if the album tag is empty. """
         mocks = {
@@ -101,6 +118,18 @@ class TestTagging(TaggingTest):
         adhesion_albums = Album.query.filter_by(artist='Adhesion').all()
         assert len(adhesion_albums) == 0
 
+    def test_search_keys(self):
+        """ Tracks and albums get case- and accent-folded search keys. """
+        create_mock_tracks({'joga.mp3': {'artist': u'Bj\xf6rk',
+                                         'title': u'J\xf3ga',
+                                         'album': u'Homogenic'}})
+        update_db(TRACK_DIR)
+        assert search_key(u'BJ\xd6RK') == u'bjork'
+        track = Track.query.filter_by(artist_key=search_key('Bjork')).one()
+        assert track.title_key == u'joga'
+        album = Album.query.filter_by(artist_key=u'bjork').one()
+        assert album.title_key == u'homogenic'
+
     def test_albums(self):
         """ Tracks with same artist/album pair get put into an Album. """
         album_mock = {
@@ -160,6 +189,7 @@ class TestUpdate(TaggingTest):
 
         create_mock_tracks({retagged_filename: before_tags})
         update_db(TRACK_DIR)
+        track_id = Track.query.filter_by(filename=retagged_filename).one().id
 
         sleep(1.2)  # Sleep so rounded-down mtime is different.
         remove_mock_tracks([retagged_filename])
@@ -170,6 +200,8 @@ class TestUpdate(TaggingTest):
                                             artist=after_tags['artist'],
                                             title=after_tags['title']).first()
         assert found_track is not None
+        assert found_track.id == track_id  # Updated in place.
+        assert found_track.artist_key == u'3rd artist'
         assert filenames_unique(Track.query.all())
 
     def test_remove_track_update(self):
@@ -182,6 +214,34 @@ class TestUpdate(TaggingTest):
         assert len(Track.query.filter_by(filename=removed_filename).all()) == 0
         assert filenames_unique(Track.query.all())
 
+    def test_removed_track_references(self):
+        """ Removed tracks are taken out of playlists, with a new version,
+        and detached from the play history. """
+        update_db(TRACK_DIR)
+        removed = Track.query.filter_by(filename='foo.mp3').one()
+        kept = Track.query.filter_by(filename='another_one.mp3').one()
+        playlist = Playlist('fake@example.com', 'Play queue')
+        db.session.add(playlist)
+        playlist.insert(removed)
+        playlist.insert(kept)
+        log = PlayLog()
+        log.record('fake@example.com', removed.id)
+        log.record('fake@example.com', kept.id)
+        log.flush()
+        version = playlist.version
+
+        remove_mock_tracks(['foo.mp3'])
+        update_db(TRACK_DIR)
+        db.session.expire_all()
+        assert playlist.version == version + 1
+        changes = playlist.changes_since(version)
+        assert len(changes) == 1 and changes[0].removed
+        assert [e.track for e in playlist.entry_range()] == [kept]
+        assert sorted(e.track_id for e in PlayEvent.query) == [None, kept.id]
+        assert [c.key for c in PlayCount.query.filter_by(kind='track')] == \
+            [unicode(kept.id)]
+        assert PlayCount.query.filter_by(kind='artist', key='Foo').one()
+
     def test_mtime(self):
         """ Updates reflect each file's mtime accurately. """
         mock_tracks = self.mock_tracks
@@ -197,6 +257,57 @@ class TestUpdate(TaggingTest):
         for track in tracks_in_db:
             assert track.mtime == now
 
+    def test_moved_track(self):
+        """ Moved or renamed files keep their track's ID. """
+        update_db(TRACK_DIR)
+        ids = dict((t.filename, t.id) for t in Track.query.all())
+
+        os.mkdir(os.path.join(TRACK_DIR, 'subdir'))
+        os.rename(os.path.join(TRACK_DIR, 'foo.mp3'),
+                  os.path.join(TRACK_DIR, 'subdir', 'moved.mp3'))
+        os.rename(os.path.join(TRACK_DIR, 'another_one.mp3'),
+                  os.path.join(TRACK_DIR, 'renamed.mp3'))
+        update_db(TRACK_DIR)
+        os.rename(os.path.join(TRACK_DIR, 'subdir', 'moved.mp3'),
+                  os.path.join(TRACK_DIR, 'foo.mp3'))
+        os.rmdir(os.path.join(TRACK_DIR, 'subdir'))
+
+        moved = Track.query.filter_by(
+            filename=os.path.join('subdir', 'moved.mp3')).one()
+        assert moved.id == ids['foo.mp3']
+        assert moved.title == 'Bar'
+        renamed = Track.query.filter_by(filename='renamed.mp3').one()
+        assert renamed.id == ids['another_one.mp3']
+        assert Track.query.count() == 3
+
+    def test_library_version(self):
+        """ The library version is bumped only when something changed. """
+        update_db(TRACK_DIR)
+        version = Library.query.one().version
+        update_db(TRACK_DIR)
+        assert Library.query.one().version == version
+        remove_mock_tracks([self.mock_tracks.keys()[0]])
+        update_db(TRACK_DIR)
+        assert Library.query.one().version == version + 1
+
+    def test_upgrade_schema(self):
+        """ Databases made before newer columns existed get them added, and
+        search keys filled in. """
+        db.drop_all()
+        db.engine.execute('CREATE TABLE track (id INTEGER PRIMARY KEY, '
+                          'artist VARCHAR(200), title VARCHAR(240), '
+                          'filename VARCHAR(256), track_num INTEGER, '
+                          'mtime INTEGER, album_id INTEGER)')
+        filename = self.mock_tracks.keys()[0]
+        mtime = int(os.path.getmtime(os.path.join(TRACK_DIR, filename)))
+        db.engine.execute('INSERT INTO track (artist, title, filename, '
+                          'mtime) VALUES (?, ?, ?, ?)',
+                          u'\xc9migr\xe9', u'Old', filename, mtime)
+        update_db(TRACK_DIR)
+        track = Track.query.filter_by(filename=filename).one()
+        assert track.title == u'Old'  # Unchanged file, so not re-read.
+        assert track.artist_key == u'emigre'
+
     def test_orphan_albums(self):
         """ Deleted tracks have their albums purged as well. """
         fname = 'blobs.mp3'
@@ -214,5 +325,344 @@ class TestUpdate(TaggingTest):
         assert found_album is None
 
 
+class TestPlaylist(DatabaseTest):
+
+    def setUp(self):
+        DatabaseTest.setUp(self)
+        self.tracks = [Track('Artist', 'Song {0}'.format(i),
+                             'song{0}.mp3'.format(i), None, i, 0)
+                       for i in range(5)]
+        db.session.add_all(self.tracks)
+        self.playlist = Playlist('fake@example.com', 'Play queue')
+        db.session.add(self.playlist)
+        db.session.flush()
+
+    def titles(self):
+        return [e.track.title for e in self.playlist.entry_range()]
+
+    def test_insert(self):
+        """ Entries are appended, or inserted before a given index. """
+        p = self.playlist
+        p.insert(self.tracks[0])
+        p.insert(self.tracks[1])
+        p.insert(self.tracks[2], 0)
+        p.insert(self.tracks[3], 2)
+        assert self.titles() == ['Song 2', 'Song 0', 'Song 3', 'Song 1']
+        assert [e.track.title for e in p.entry_range(1, 2)] == \
+            ['Song 0', 'Song 3']
+
+    def test_move(self):
+        """ Moving an entry only changes that entry's row. """
+        p = self.playlist
+        entries = [p.insert(t) for t in self.tracks]
+        other_positions = [e.position for e in entries[1:]]
+        p.move(entries[0], 3)
+        assert self.titles() == ['Song 1', 'Song 2', 'Song 3', 'Song 0',
+                                 'Song 4']
+        assert [e.position for e in entries[1:]] == other_positions
+        p.move(entries[4], 0)
+        assert self.titles() == ['Song 4', 'Song 1', 'Song 2', 'Song 3',
+                                 'Song 0']
+
+    def test_renumber(self):
+        """ Repeated inserts into the same spot still keep order. """
+        p = self.playlist
+        p.insert(self.tracks[0])
+        p.insert(self.tracks[1])
+        for _ in range(40):
+            p.insert(self.tracks[2], 1)
+        titles = self.titles()
+        assert len(titles) == 42
+        assert titles[0] == 'Song 0' and titles[-1] == 'Song 1'
+
+    def test_version_in_sql(self):
+        """ Versions are taken from the database, not a stale copy. """
+        p = self.playlist
+        p.insert(self.tracks[0])
+        Playlist.query.filter_by(id=p.id).update(
+            {Playlist.version: 10}, synchronize_session=False)
+        entry = p.insert(self.tracks[1])
+        assert p.version == entry.version == 11
+        db.session.expire(p)
+        assert p.version == 11
+
+    def test_changes_since(self):
+        """ Only entries touched after a version are reported, including
+        removed ones. """
+        p = self.playlist
+        entries = [p.insert(t) for t in self.tracks[:3]]
+        version = p.version
+        p.remove(entries[1])
+        p.insert(self.tracks[3])
+        changes = p.changes_since(version)
+        assert len(changes) == 2
+        assert changes[0].removed and changes[0].id == entries[1].id
+        assert changes[1].track.title == 'Song 3'
+        assert self.titles() == ['Song 0', 'Song 2', 'Song 3']
+
+    def test_compact(self):
+        """ Old tombstones are deleted, and clients that might have missed
+        them are told to re-read the playlist. """
+        p = self.playlist
+        p.TOMBSTONE_VERSIONS = 2
+        p.COMPACT_INTERVAL = 1
+        entries = [p.insert(t) for t in self.tracks]
+        p.remove(entries[0])
+        p.remove(entries[1])
+        for t in self.tracks[:3]:
+            p.insert(t)
+        p.remove(entries[2])
+        assert p.version == 11 and p.compacted_version == 9
+        removed = p.entries.filter_by(removed=True).all()
+        assert removed == [entries[2]]
+        assert p.changes_since(8) is None
+        assert len(p.changes_since(9)) == 2
+        assert p.changes_since(10) == [entries[2]]
+        assert self.titles() == ['Song 3', 'Song 4', 'Song 0', 'Song 1',
+                                 'Song 2']
+
+
+class TestPlayHistory(DatabaseTest):
+
+    def setUp(self):
+        DatabaseTest.setUp(self)
+        album = Album('Artist', 'Album')
+        self.tracks = [Track('Artist', 'Song {0}'.format(i),
+                             'song{0}.mp3'.format(i), album, i, 0)
+                       for i in range(3)]
+        db.session.add_all(self.tracks)
+        db.session.commit()
+        self.log = PlayLog(batch_size=1000, max_delay=1000)
+
+    def plays(self, kind, key):
+        count = PlayCount.query.filter_by(kind=kind, key=key).first()
+        return count.plays if count else 0
+
+    def test_buffered(self):
+        """ Plays are only written when the log is flushed. """
+        self.log.record('fake@example.com', self.tracks[0].id)
+        assert PlayEvent.query.count() == 0
+        assert self.log.flush() == 1
+        assert PlayEvent.query.count() == 1
+        assert self.log.pending() == 0
+        self.log.record('fake@example.com', self.tracks[0].id)
+        self.log.flush()
+        assert self.plays('track', unicode(self.tracks[0].id)) == 2
+
+    def test_failed_flush(self):
+        """ Events are kept for the next flush if writing them fails. """
+        self.log.record('fake@example.com', self.tracks[0].id)
+        db.session.execute('DROP TABLE play_event')
+        assert self.log.flush() == 0
+        assert self.log.pending() == 1
+        PlayEvent.__table__.create(db.engine)
+        assert self.log.flush() == 1
+        assert self.plays('track', unicode(self.tracks[0].id)) == 1
+
+    def test_dropped_after_failures(self):
+        """ Events are dropped once writing them has failed `max_attempts`
+        times, and failures stop new events from triggering writes. """
+        log = PlayLog(batch_size=2, max_delay=1000, max_attempts=2)
+        log.record('fake@example.com', self.tracks[0].id)
+        db.session.execute('DROP TABLE play_event')
+        assert log.flush() == 0
+        log.record('fake@example.com', self.tracks[1].id)
+        assert not log._flushing
+        assert log.pending() == 2
+        assert log.flush() == 0
+        assert log.pending() == 0
+        PlayEvent.__table__.create(db.engine)
+
+    def test_rollups(self):
+        """ Flushing updates the per-track, album, artist and day totals.
+        """
+        day = 86400 * 1000
+        for i, when in [(0, day), (0, day + 1), (1, day + 2), (2, 2 * day)]:
+            self.log.record('fake@example.com', self.tracks[i].id, when)
+        self.log.record('fake@example.com', 12345)  # Unknown track.
+        assert self.log.flush() == 4
+
+        assert self.plays('track', unicode(self.tracks[0].id)) == 2
+        assert self.plays('track', unicode(self.tracks[2].id)) == 1
+        assert self.plays('album', unicode(self.tracks[0].album_id)) == 4
+        assert self.plays('artist', 'Artist') == 4
+        assert self.plays('day', '1972-09-27') == 3
+
+        before = [(c.kind, c.key, c.plays) for c in PlayCount.query.all()]
+        rebuild_rollups()
+        after = [(c.kind, c.key, c.plays) for c in PlayCount.query.all()]
+        assert sorted(before) == sorted(after)
+
+
+class TestSearchIndex(TaggingTest):
+
+    def test_prefix_search(self):
+        """ Every prefix has to start some word of the document. """
+        index = PrefixIndex([(1, u'Foo Bar'), (2, u'Food Fight'),
+                             (3, u'Barn Owl'), (4, u'Other')])
+        assert sorted(index.search([u'foo'], 10)) == [1, 2]
+        assert sorted(index.search([u'bar'], 10)) == [1, 3]
+        assert index.search([u'foo', u'ba'], 10) == [1]
+        assert index.search([u'owls'], 10) == []
+        assert len(index.search([u'o'], 2)) == 2
+
+    def test_dense_prefixes(self):
+        """ Prefixes that get bitmaps match the same documents, whether
+        combined with each other or with prefixes that don't. """
+        class DenseIndex(PrefixIndex):
+            MIN_DENSE_POSTINGS = 3
+            CHECK_LIMIT = 1
+
+        docs = [(1, u'Foo Bar'), (2, u'Food Fight'), (3, u'Barn Owl'),
+                (4, u'Foo Fighters'), (5, u'Bar Fly'), (6, u'Foo')]
+        dense = DenseIndex(docs)
+        assert sorted(dense.bitmaps) == [u'b', u'ba', u'bar', u'f', u'fo',
+                                         u'foo']
+        sparse = PrefixIndex(docs)
+        assert sparse.bitmaps == {}
+        for query in ([u'foo'], [u'foo', u'f'], [u'f', u'bar'],
+                      [u'foo', u'fi'], [u'owl', u'bar'], [u'fig', u'food'],
+                      [u'o']):
+            assert dense.search(query, 10) == sparse.search(query, 10)
+        assert dense.search([u'f', u'b'], 10) == [1, 5]
+        assert dense.search([u'f', u'fi'], 1) == [2]
+
+    def test_engine(self):
+        """ The engine indexes tracks and albums from the database. """
+        create_mock_tracks({'album.mp3': {'artist': 'Foo', 'title': 'Baz',
+                                          'album': 'Quux'}})
+        update_db(TRACK_DIR)
+        engine = SearchEngine()
+        engine.rebuild()
+
+        album_ids, track_ids = engine.search(['FOO', 'qu'], 30, 10)
+        assert [a.title for a in Album.query.filter(
+            Album.id.in_(album_ids))] == ['Quux']
+        assert track_ids == []
+
+        album_ids, track_ids = engine.search(['FOO', 'ba'], 30, 10)
+        assert album_ids == []
+        titles = [t.title for t in Track.query.filter(
+            Track.id.in_(track_ids))]
+        assert sorted(titles) == ['Bar', 'Baz']
+        assert engine.search(['!!!'], 30, 10) is None
+
+    def test_database_fallback(self):
+        """ Without the index, the database gives the same results. """
+        create_mock_tracks({
+            'joga.mp3': {'artist': u'Bj\xf6rk', 'title': u'J\xf3ga'},
+            'tnt.mp3': {'artist': 'AC/DC', 'title': 'T.N.T.'},
+            'bang.mp3': {'artist': '!!!', 'title': 'Heart of Hearts'}
+        })
+        update_db(TRACK_DIR)
+        engine = SearchEngine()
+        engine.rebuild()
+        for tokens in (['ork'], ['bjo'], ['dc'], ['t', 'n'], ['of', 'hea'],
+                       ['o'], []):
+            _, track_ids = engine.search(tokens, 30, 10)
+            assert [t.id for t in search_database(Track, tokens, 30)] == \
+                track_ids
+        assert search_database(Track, ['ork'], 30) == []
+        assert [t.title for t in search_database(Track, ['!!!'], 30)] == \
+            ['Heart of Hearts']
+        assert engine.search(['!!!', 'heart'], 30, 10) is None
+        assert search_database(Track, ['!!!', 'ar'], 30) == []
+
+    def test_memory_budget(self):
+        """ No index is built if it wouldn't fit in the memory budget. """
+        update_db(TRACK_DIR)
+        engine = SearchEngine(max_memory_mb=0)
+        engine.rebuild()
+        assert engine.tracks is None
+        assert engine.search(['foo'], 30, 10) is None
+
+
+class FakePipe(object):
+    """ Stands in for a Popen object whose output is `output`. """
+
+    def __init__(self, output):
+        self.stdout = StringIO(output)
+        self.returncode = None
+
+    def terminate(self):
+        self.returncode = -15
+
+    def wait(self):
+        if self.returncode is None:
+            self.returncode = 0
+
+
+class TestTranscode(unittest.TestCase):
+
+    def test_choose_profile(self):
+        """ The best-fitting profile in a wanted format is chosen. """
+        profiles = transcode.PROFILES
+        low = transcode.target_bitrate('low')
+        assert transcode.choose_profile(
+            profiles, ['mp3', 'ogg', 'opus'], low).name == 'opus-64'
+        assert transcode.choose_profile(
+            profiles, ['ogg'], low).name == 'vorbis-q5'
+        assert transcode.choose_profile(
+            profiles, ['mp3'], transcode.target_bitrate('high', 160)
+        ).name == 'mp3-128'
+        assert transcode.choose_profile(profiles, ['wma'], low) is None
+
+        # By default, the most efficient codec the browser has is used.
+        high = transcode.target_bitrate('high')
+        defaults = transcode.enabled_profiles()
+        assert transcode.choose_profile(
+            defaults, ['mp3', 'ogg', 'm4a', 'opus'], high).name == 'opus-128'
+        assert transcode.choose_profile(
+            defaults, ['ogg', 'm4a'], high).name == 'vorbis-q5'
+        assert transcode.choose_profile(
+            defaults, ['mp3', 'm4a'], high).name == 'mp3-192'
+        assert transcode.choose_profile(defaults, ['m4a'], high) is None
+        assert [p.name for p in transcode.enabled_profiles(
+            'mp3-128,opus-64')] == ['opus-64', 'mp3-128']
+
+    def test_cache(self):
+        """ Piped output is cached only once it has all been read. """
+        cache_filename = os.path.join(TRACK_DIR, 'cached.ogg')
+        wrapper = PipeWrapper(FakePipe('audio'), buffer_size=2,
+                              cache_filename=cache_filename)
+        wrapper.next()
+        wrapper.close()
+        assert not os.path.exists(cache_filename)
+
+        wrapper = PipeWrapper(FakePipe('audio'),
+                              cache_filename=cache_filename)
+        data = ''.join(wrapper)
+        wrapper.close()
+        with open(cache_filename) as f:
+            assert f.read() == data == 'audio'
+        os.remove(cache_filename)
+        # No temporary files are left behind.
+        assert not [f for f in os.listdir(TRACK_DIR) if f.startswith('tmp')]
+
+    def test_prune_cache(self):
+        """ Cached copies of old file versions and removed tracks go. """
+        cache_dir = os.path.join(TRACK_DIR, 'cache')
+        profile = transcode.PROFILES[0]
+        old = Track('A', 'T', 'a.mp3', None, 1, 0, content_hash='old')
+        new = Track('A', 'T', 'a.mp3', None, 1, 0, content_hash='new')
+        gone = Track('A', 'T', 'b.mp3', None, 1, 0, content_hash='x')
+        old.id = new.id = 1
+        gone.id = 2
+        for track in (old, gone):
+            filename = profile.cache_filename(cache_dir, track)
+            transcode.prepare_cache(filename, track)
+            open(filename, 'w').close()
+
+        new_filename = profile.cache_filename(cache_dir, new)
+        transcode.prepare_cache(new_filename, new)
+        open(new_filename, 'w').close()
+        profile_dir = os.path.join(cache_dir, profile.name)
+        assert sorted(os.listdir(profile_dir)) == ['1-new.opus', '2-x.opus']
+
+        assert transcode.prune_cache(cache_dir, [new]) == 1
+        assert os.listdir(profile_dir) == ['1-new.opus']
+        shutil.rmtree(cache_dir)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,177 @@
+import errno
+import glob
+import os
+
+# Formats that avconv can read, by file extension.
+TRANSCODABLE_FORMATS = ['mp3', 'ogg', 'opus', 'flac', 'm4a', 'wav']
+
+# Target bitrates (in bits per second) for each `quality` hint.
+QUALITY_BITRATES = {
+    'low': 64000,
+    'medium': 128000,
+    'high': 192000
+}
+DEFAULT_QUALITY = 'high'
+
+
+class Profile(object):
+    """ One output format and bitrate that tracks can be transcoded to.
+
+    `format` is the file extension that clients list in `wanted_formats`,
+    and `args` are the avconv output options that produce it. `quality` is
+    roughly the MP3 bitrate that would sound as good, so that profiles of
+    different codecs can be compared. Transcoded files are cached under a
+    directory named after the profile.
+
+    Profiles that aren't `default` are only used if named in the
+    TRANSCODE_PROFILES setting.
+    """
+
+    def __init__(self, name, format, mimetype, bitrate, quality, args,
+                 default=True):
+        self.name = name
+        self.format = format
+        self.mimetype = mimetype
+        self.bitrate = bitrate  # Approximate average, in bits per second.
+        self.quality = quality
+        self.args = args
+        self.default = default
+
+    def __repr__(self):
+        return '<Profile {0.name}>'.format(self)
+
+    def command(self, input_filename):
+        """ The avconv command line that transcodes `input_filename` to
+        standard output. """
+        return (['avconv', '-v', 'quiet', '-i', input_filename] +
+                self.args + ['-'])
+
+    def cache_filename(self, cache_dir, track):
+        """ Where `track`'s transcoded audio is cached. The content hash
+        (or mtime) is part of the name, so an edited file isn't served
+        stale. """
+        return os.path.join(cache_dir, self.name, u'{0}.{1}'.format(
+            cache_key(track), self.format))
+
+    def estimated_size(self, track):
+        """ Estimated size of `track` in this profile, in bytes. """
+        if not track.duration:
+            return None
+        return int(track.duration * self.bitrate / 8)
+
+
+def cache_key(track):
+    """ The part of a cached file's name that identifies the track and the
+    version of its file. """
+    return u'{0}-{1}'.format(track.id, track.content_hash or track.mtime)
+
+
+def prepare_cache(cache_filename, track):
+    """ Get ready to cache `track` as `cache_filename`: make sure its
+    directory exists, and remove any copies there made from older versions
+    of the track's file. """
+    cache_dir = os.path.dirname(cache_filename)
+    try:
+        os.makedirs(cache_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:  # Another request may have made it.
+            raise
+
+    for stale in glob.glob(os.path.join(cache_dir,
+                                        u'{0}-*'.format(track.id))):
+        if stale != cache_filename:
+            try:
+                os.remove(stale)
+            except OSError:
+                pass  # Already removed by another request.
+
+
+def prune_cache(cache_dir, tracks):
+    """ Remove files in `cache_dir` that aren't the current version of one
+    of `tracks`, e.g. because the track has left the library. Returns the
+    number of files removed. """
+    keys = set(cache_key(t) for t in tracks)
+    removed = 0
+    for profile in PROFILES:
+        profile_dir = os.path.join(cache_dir, profile.name)
+        if not os.path.isdir(profile_dir):
+            continue
+        for filename in os.listdir(profile_dir):
+            if filename.startswith('tmp'):
+                continue  # Still being written.
+            if os.path.splitext(filename)[0] not in keys:
+                os.remove(os.path.join(profile_dir, filename))
+                removed += 1
+    return removed
+
+
+def opus(bitrate):
+    return Profile('opus-{0}'.format(bitrate // 1000), 'opus',
+                   'audio/ogg; codecs=opus', bitrate, bitrate * 3 // 2,
+                   ['-f', 'ogg', '-acodec', 'libopus',
+                    '-b:a', str(bitrate)])
+
+
+def aac(bitrate):
+    # Fragmented MP4, since a normal one can't be written to a pipe.
+    # libav's native AAC encoder is experimental and not very good, so
+    # these are off unless asked for.
+    return Profile('aac-{0}'.format(bitrate // 1000), 'm4a', 'audio/mp4',
+                   bitrate, bitrate,
+                   ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov',
+                    '-acodec', 'aac', '-strict', 'experimental',
+                    '-b:a', str(bitrate)],
+                   default=False)
+
+
+def mp3(bitrate):
+    return Profile('mp3-{0}'.format(bitrate // 1000), 'mp3', 'audio/mpeg',
+                   bitrate, bitrate,
+                   ['-f', 'mp3', '-acodec', 'libmp3lame',
+                    '-b:a', str(bitrate)])
+
+
+# All available profiles, most preferred first: between profiles of equal
+# quality and bitrate, the earlier one is chosen.
+PROFILES = [
+    opus(48000), opus(64000), opus(96000), opus(128000),
+    Profile('vorbis-q5', 'ogg', 'audio/ogg', 160000, 192000,
+            ['-f', 'ogg', '-acodec', 'libvorbis', '-aq', '5']),
+    mp3(128000), mp3(192000), mp3(256000),
+    aac(96000), aac(128000), aac(192000)
+]
+
+
+def enabled_profiles(names=None):
+    """ Return the profiles named in `names` (a comma-separated string), or
+    the default ones if it's empty. """
+    if not names:
+        return [p for p in PROFILES if p.default]
+    names = names.split(',')
+    return [p for p in PROFILES if p.name in names]
+
+
+def target_bitrate(quality=None, max_bitrate=None):
+    """ The bitrate to aim for, given a client's `quality` hint (a key of
+    QUALITY_BITRATES) and/or `max_bitrate` (in kbps). Returns None if
+    neither was given. """
+    targets = []
+    if quality in QUALITY_BITRATES:
+        targets.append(QUALITY_BITRATES[quality])
+    if max_bitrate is not None:
+        targets.append(max_bitrate * 1000)
+    return min(targets) if targets else None
+
+
+def choose_profile(profiles, wanted_formats, bitrate):
+    """ Pick the profile, among those in a wanted format, with the best
+    quality for a bitrate not over `bitrate` (preferring the lower bitrate
+    if two sound alike), or failing that the lowest bitrate. Returns None
+    if no profile is in a wanted format. """
+    candidates = [p for p in profiles if p.format in wanted_formats]
+    if not candidates:
+        return None
+    fitting = [p for p in candidates if p.bitrate <= bitrate]
+    if fitting:
+        return max(fitting, key=lambda p: (p.quality, -p.bitrate))
+    return min(candidates, key=lambda p: p.bitrate)
@@ -1,17 +1,41 @@
+import os
+import tempfile
+
+
 class PipeWrapper(object):
     """ Like Flask's FileWrapper, but designed for processes opened with
     Popen(). While FileWrapper *almost* works with pipes, it doesn't
     terminate the underlying process once the pipe is closed. This does.
+
+    If `cache_filename` is given, everything read is also saved there, but
+    only once the process has finished successfully and all its output has
+    been read; an interrupted stream leaves nothing behind.
     """
 
-    def __init__(self, pipe, buffer_size=8192):
+    def __init__(self, pipe, buffer_size=8192, cache_filename=None):
         self.pipe = pipe
         self.buffer_size = buffer_size
+        self.cache_filename = cache_filename
+        self.cache_file = None
+        self.finished = False
+        if cache_filename is not None:
+            # Write to a temporary file in the same directory, then rename
+            # it, so nobody can see a partial file under the real name.
+            fd, self.cache_temp = tempfile.mkstemp(
+                dir=os.path.dirname(cache_filename))
+            self.cache_file = os.fdopen(fd, 'wb')
 
     def close(self):
         self.pipe.stdout.close()
-        self.pipe.terminate()
+        if not self.finished:
+            self.pipe.terminate()
         self.pipe.wait()
+        if self.cache_file is not None:
+            self.cache_file.close()
+            if self.finished and self.pipe.returncode == 0:
+                os.rename(self.cache_temp, self.cache_filename)
+            else:
+                os.remove(self.cache_temp)
 
     def __iter__(self):
         return self
@@ -19,5 +43,8 @@ class PipeWrapper(object):
     def next(self):
         data = self.pipe.stdout.read(self.buffer_size)
         if data:
+            if self.cache_file is not None:
+                self.cache_file.write(data)
             return data
+        self.finished = True
         raise StopIteration()